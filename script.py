@@ -1,10 +1,18 @@
 import os
 import json
+import sqlite3
+import asyncio
+import re
 import mimetypes
 import zipfile
 import time
 import random
 import hashlib
+import logging
+import threading
+import tempfile
+from collections import OrderedDict
+from contextlib import closing
 from datetime import date
 from io import BytesIO
 
@@ -14,11 +22,12 @@ from google.genai import types
 
 # PDF renderer with no system deps
 import fitz  # PyMuPDF
+from PIL import Image
 
 # for DOCX output
 from docx import Document             # pip install python-docx
 # for PDF output
-from fpdf import FPDF                 # pip install fpdf
+from fpdf import FPDF                 # pip install fpdf2
 
 # ←── PAGE & THEME CONFIG ──────────────────────────────────────────────────────
 st.set_page_config(
@@ -54,11 +63,33 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+log = logging.getLogger(__name__)
+
 # ←── API & USAGE ───────────────────────────────────────────────────────────────
 # DEFAULT_API_KEY = " "
 DEFAULT_API_KEY = st.secrets["genai"]["api_key"]
-USAGE_FILE = "usage.json"
+USAGE_FILE = "usage.db"
+LEGACY_USAGE_FILE = "usage.json"  # pre-sqlite counter, migrated on first use
+CACHE_DIR = ".ocr_cache"  # persistent OCR results, one {sha1}.txt per image+prompt
 DAILY_LIMIT = 5
+RENDER_DPI = 150      # plenty for handwriting; 200-DPI PNGs were multi-MB uploads
+MAX_SIDE_PX = 2000    # clamp huge pages at render time instead of downscaling later
+JPEG_QUALITY = 80
+RENDER_CACHE_PAGES = 256    # rendered page JPEGs kept in memory, across all users
+RENDER_CACHE_TTL_S = 3600
+OCR_CONCURRENCY = 8  # max in-flight Gemini requests (keep under the RPM tier)
+OCR_BATCH = 10       # pages per Gemini request; amortises per-call overhead
+MIN_EMBEDDED_CHARS = 50   # PDF pages with a text layer this long skip OCR...
+MIN_EMBEDDED_ALPHA = 0.6  # ...if at least this share of it is letters
+PDF_FONT_FILE = "DejaVuSans.ttf"  # optional unicode TTF for PDF output
+PAGE_BREAK = "\n\n--- Page Break ---\n\n"
+
+@st.cache_resource
+def get_client(api_key: str) -> genai.Client:
+    # one client (and its HTTP connection pool) per key, reused across reruns.
+    # Only its sync side is safe to share: the async pool is bound to the event
+    # loop that opened it, so ocr_pages() builds its own client per asyncio.run.
+    return genai.Client(api_key=api_key)
 
 def guess_mime(fname: str) -> str:
     mime, _ = mimetypes.guess_type(fname)
@@ -68,84 +99,583 @@ def guess_mime(fname: str) -> str:
 def _sha1(b: bytes) -> str:
     return hashlib.sha1(b).hexdigest()
 
-_OCR_CACHE = {}
+OCR_CACHE_MAX_ITEMS = 1024
+OCR_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+@st.cache_resource
+def _ocr_cache():
+    # in-memory LRU in front of the disk cache, bounded by entry count and text
+    # size. Held in cache_resource: script globals are rebuilt on every rerun.
+    return {"items": OrderedDict(), "bytes": 0, "lock": threading.Lock()}
+
+def _mem_get(key: str):
+    cache = _ocr_cache()
+    with cache["lock"]:
+        text = cache["items"].get(key)
+        if text is not None:
+            cache["items"].move_to_end(key)
+        return text
+
+def _mem_put(key: str, text: str) -> None:
+    cache = _ocr_cache()
+    items = cache["items"]
+    with cache["lock"]:
+        old = items.pop(key, None)
+        if old is not None:
+            cache["bytes"] -= len(old)
+        items[key] = text
+        cache["bytes"] += len(text)
+        while len(items) > 1 and (len(items) > OCR_CACHE_MAX_ITEMS
+                                  or cache["bytes"] > OCR_CACHE_MAX_BYTES):
+            _, evicted = items.popitem(last=False)
+            cache["bytes"] -= len(evicted)
+
+@st.cache_resource
+def _cache_write_lock() -> threading.Lock:
+    # one lock shared by every session on this server
+    return threading.Lock()
+
+def _cache_key(data: bytes, prompt: str) -> str:
+    return _sha1(data + prompt.encode("utf-8"))
+
+def _cache_get(key: str):
+    """Memory first, then the on-disk cache (shared across sessions/restarts)."""
+    text = _mem_get(key)
+    if text is not None:
+        return text
+    path = os.path.join(CACHE_DIR, key + ".txt")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if text:  # ignore blank entries left by older versions
+            _mem_put(key, text)
+            return text
+    return None
+
+def _cache_put(key: str, text: str) -> None:
+    # blank text may be a safety block, a flaky empty reply or a mis-split
+    # batch: don't pin it for every future run, just let the next one retry
+    if not text:
+        return
+    _mem_put(key, text)
+    path = os.path.join(CACHE_DIR, key + ".txt")
+    tmp = path + ".tmp"
+    # best-effort: a full disk or read-only dir must not throw away a good OCR result
+    try:
+        with _cache_write_lock():
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, path)  # atomic: readers never see a half-written file
+    except OSError as e:
+        log.warning("Could not write OCR cache file %s: %s", path, e)
+
+OCR_MODELS = [
+    "gemini-2.5-flash",
+    "gemini-1.5-flash",
+    "gemini-1.5-flash-8b",
+]
+
+RETRY_BASE_S = 0.8  # base backoff seconds
+# 429 is a quota wall worth waiting out; 503 usually means "try the next model"
+MAX_ATTEMPTS = {"rate_limit": 8, "unavailable": 4}
+MAX_RETRY_DELAY_S = 60  # a longer server-suggested wait means "give up on this model"
+
+_RETRY_HINT = re.compile(
+    r"(?:retry in |retryDelay['\"]?:\s*['\"])(\d+(?:\.\d+)?)s", re.IGNORECASE
+)
+
+def _retry_kind(e: Exception):
+    """'rate_limit' (429), 'unavailable' (503/deadline) or None for non-retryable errors."""
+    # match the API's status code/name, not bare digits ("... 1429 tokens" is a 400)
+    code = getattr(e, "code", None)
+    status = getattr(e, "status", None) or ""
+    msg = str(e)
+    if code == 429 or status == "RESOURCE_EXHAUSTED" or "RESOURCE_EXHAUSTED" in msg:
+        return "rate_limit"
+    if code == 503 or status == "UNAVAILABLE" or "UNAVAILABLE" in msg:
+        return "unavailable"
+    if "deadline" in msg.lower():
+        return "unavailable"
+    return None
+
+def _retry_delay(e: Exception, kind: str, attempt: int) -> float:
+    """Server-suggested delay for 429s when present, else exponential backoff + jitter."""
+    if kind == "rate_limit":
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        hint = headers.get("retry-after")
+        if hint is None:
+            m = _RETRY_HINT.search(str(e))
+            hint = m and m.group(1)
+        try:
+            if hint:
+                return float(hint)
+        except ValueError:
+            pass
+    return RETRY_BASE_S * (2 ** attempt) + random.uniform(0, 0.5)
+
+def _retry_wait(e: Exception, attempts: dict):
+    """Seconds to sleep before the next attempt, or None once this model should be abandoned."""
+    kind = _retry_kind(e)
+    if kind is None:
+        raise e
+    attempt = attempts[kind]
+    attempts[kind] += 1
+    if attempts[kind] >= MAX_ATTEMPTS[kind]:
+        return None
+    sleep_s = _retry_delay(e, kind, attempt)
+    if sleep_s > MAX_RETRY_DELAY_S:
+        return None
+    if kind == "rate_limit":
+        st.toast(f"Rate-limited, waiting {sleep_s:.1f}s")
+    return sleep_s
+
+INFLIGHT_WAIT_S = 60  # how long to wait for another session OCR-ing the same page
+INFLIGHT_POLL_S = 0.25
+
+@st.cache_resource
+def _inflight_registry():
+    # cache_key -> Event for OCR calls currently running, shared by every session
+    return {}, threading.Lock()
+
+def _inflight_claim(key: str):
+    """None if the caller now owns `key`; otherwise the Event to wait on."""
+    inflight, lock = _inflight_registry()
+    with lock:
+        ev = inflight.get(key)
+        if ev is None:
+            inflight[key] = threading.Event()
+        return ev
+
+def _inflight_release(key: str) -> None:
+    inflight, lock = _inflight_registry()
+    with lock:
+        ev = inflight.pop(key, None)
+    if ev is not None:
+        ev.set()
+
+def _generate(client: genai.Client, contents: list) -> str:
+    last_err = None
+    for model in OCR_MODELS:
+        attempts = {"rate_limit": 0, "unavailable": 0}
+        while True:
+            try:
+                resp = client.models.generate_content(
+                    model=model,
+                    contents=contents,
+                )
+                return (getattr(resp, "text", "") or "").strip()
+            except Exception as e:
+                # non-retryable errors bubble up out of _retry_wait
+                sleep_s = _retry_wait(e, attempts)
+                last_err = e
+                if sleep_s is None:
+                    break
+                time.sleep(sleep_s)
+        # exhausted retries for this model; try next
+        last_err = last_err or RuntimeError(f"Model {model} failed after retries.")
+    # all models failed
+    raise last_err or RuntimeError("All OCR attempts failed.")
 
 def ocr_with_gemini(client: genai.Client, data: bytes, fname: str, prompt: str) -> str:
     """
     Robust OCR call:
-    - retries on 503/UNAVAILABLE with exponential backoff + jitter
+    - retries 429s after the server's retry delay, 503/UNAVAILABLE with backoff + jitter
     - falls back across several Gemini vision models
-    - caches identical image bytes within the session
+    - caches identical image bytes in memory and on disk (CACHE_DIR)
+    - if another session is already OCR-ing the same image, waits for its result
     """
-    cache_key = (_sha1(data), prompt)
-    if cache_key in _OCR_CACHE:
-        return _OCR_CACHE[cache_key]
-
-    models = [
-        "gemini-2.5-flash",
-        "gemini-1.5-flash",
-        "gemini-1.5-flash-8b",
-    ]
-
+    cache_key = _cache_key(data, prompt)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    ev = _inflight_claim(cache_key)
+    if ev is not None:
+        ev.wait(timeout=INFLIGHT_WAIT_S)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+        # the other caller failed or timed out: do it ourselves below
+    try:
+        cached = _cache_get(cache_key)  # may have landed between the checks
+        if cached is not None:
+            return cached
+        part = types.Part.from_bytes(data=data, mime_type=guess_mime(fname))
+        text = _generate(client, [part, prompt])
+        _cache_put(cache_key, text)
+        return text
+    finally:
+        if ev is None:
+            _inflight_release(cache_key)
+
+async def _generate_async(client: genai.Client, contents: list) -> str:
+    """Retry/fallback loop shared by the async OCR paths (asyncio.sleep backoff)."""
     last_err = None
-    for model in models:
-        base = 0.8  # base backoff seconds
-        for attempt in range(6):  # ~0.8s → ~25s worst-case for a single model
+    for model in OCR_MODELS:
+        attempts = {"rate_limit": 0, "unavailable": 0}
+        while True:
             try:
-                part = types.Part.from_bytes(data=data, mime_type=guess_mime(fname))
-                resp = client.models.generate_content(
+                resp = await client.aio.models.generate_content(
                     model=model,
-                    contents=[part, prompt],
+                    contents=contents,
                 )
-                text = (getattr(resp, "text", "") or "").strip()
-                _OCR_CACHE[cache_key] = text
-                return text
+                return (getattr(resp, "text", "") or "").strip()
             except Exception as e:
-                msg = str(e)
-                if ("503" in msg) or ("UNAVAILABLE" in msg) or ("deadline" in msg.lower()):
-                    # transient → retry with backoff + jitter
-                    sleep_s = base * (2 ** attempt) + random.uniform(0, 0.5)
-                    time.sleep(sleep_s)
-                    last_err = e
-                    continue
-                # non-transient → bubble up
-                raise
-        # exhausted retries for this model; try next
+                sleep_s = _retry_wait(e, attempts)
+                last_err = e
+                if sleep_s is None:
+                    break
+                await asyncio.sleep(sleep_s)
         last_err = last_err or RuntimeError(f"Model {model} failed after retries.")
-    # all models failed
     raise last_err or RuntimeError("All OCR attempts failed.")
 
+async def _ocr_owned_async(client: genai.Client, data: bytes, fname: str, prompt: str,
+                           sem: asyncio.Semaphore) -> str:
+    # caller already holds the in-flight claim for this image
+    async with sem:
+        part = types.Part.from_bytes(data=data, mime_type=guess_mime(fname))
+        text = await _generate_async(client, [part, prompt])
+    _cache_put(_cache_key(data, prompt), text)
+    return text
+
+async def _wait_inflight_async(ev: threading.Event) -> None:
+    # poll instead of ev.wait in a worker thread: waiters must not tie up the
+    # loop's default executor, which the owner's own connection setup needs
+    deadline = asyncio.get_running_loop().time() + INFLIGHT_WAIT_S
+    while not ev.is_set() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(INFLIGHT_POLL_S)
+
+async def ocr_async(client: genai.Client, data: bytes, fname: str, prompt: str,
+                    sem: asyncio.Semaphore) -> str:
+    """
+    Async twin of ocr_with_gemini for multi-page inputs:
+    - same retry/fallback/cache/single-flight behaviour, but never blocks the loop
+    - `sem` bounds how many requests are in flight at once
+    """
+    cache_key = _cache_key(data, prompt)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    ev = _inflight_claim(cache_key)
+    if ev is not None:
+        await _wait_inflight_async(ev)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+        return await _ocr_owned_async(client, data, fname, prompt, sem)
+    try:
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+        return await _ocr_owned_async(client, data, fname, prompt, sem)
+    finally:
+        _inflight_release(cache_key)
+
+_PAGE_MARKER = re.compile(r"^===PAGE (\d+)===[ \t]*$", re.MULTILINE)
+
+def _split_batch(text: str, n: int):
+    """Split a batched reply on ===PAGE k=== markers; None unless pages 1..n all appear in order."""
+    marks = list(_PAGE_MARKER.finditer(text))
+    if [int(m.group(1)) for m in marks] != list(range(1, n + 1)):
+        return None
+    ends = [m.start() for m in marks[1:]] + [len(text)]
+    return [text[m.end():end].strip() for m, end in zip(marks, ends)]
+
+async def _ocr_owned_batch(client: genai.Client, items: list, prompt: str,
+                           sem: asyncio.Semaphore, on_item) -> list:
+    if len(items) > 1:
+        batch_prompt = (
+            f"{prompt}\n\nYou are given {len(items)} images, one per page, in order. "
+            "Transcribe each one separately. Start each page's output with a line "
+            "containing exactly ===PAGE n=== (n = 1, 2, ...) and output nothing else."
+        )
+        contents = [
+            types.Part.from_bytes(data=data, mime_type=guess_mime(fname))
+            for fname, data in items
+        ] + [batch_prompt]
+        try:
+            async with sem:
+                texts = _split_batch(await _generate_async(client, contents), len(items))
+        except Exception:
+            texts = None
+        if texts is not None:
+            for pos, ((_, data), text) in enumerate(zip(items, texts)):
+                _cache_put(_cache_key(data, prompt), text)
+                on_item(pos, text)
+            return texts
+
+    async def one(pos, fname, data):
+        try:
+            text = await _ocr_owned_async(client, data, fname, prompt, sem)
+        except Exception as e:
+            text = e
+        on_item(pos, text)
+        return text
+
+    return await asyncio.gather(
+        *(one(pos, fname, data) for pos, (fname, data) in enumerate(items))
+    )
+
+async def ocr_batch_async(client: genai.Client, items: list, prompt: str,
+                          sem: asyncio.Semaphore, on_item=None) -> list:
+    """
+    OCR several (fname, bytes) images in one request, one text per image.
+    If the batched call fails or its reply can't be split cleanly, each image
+    is retried on its own; per-image failures come back as exceptions.
+    Images another session is already OCR-ing are waited on, not re-sent.
+    `on_item(pos, text)` is called as soon as each image's result is known.
+    """
+    on_item = on_item or (lambda pos, text: None)
+    results = [None] * len(items)
+    owned, waiting = [], []
+    for pos, (_, data) in enumerate(items):
+        cache_key = _cache_key(data, prompt)
+        if _inflight_claim(cache_key) is not None:
+            waiting.append(pos)
+            continue
+        # the previous owner may have finished between our cache miss and the claim
+        cached = _cache_get(cache_key)
+        if cached is None:
+            owned.append(pos)
+            continue
+        _inflight_release(cache_key)
+        results[pos] = cached
+        on_item(pos, cached)
+
+    async def run_owned():
+        try:
+            return await _ocr_owned_batch(
+                client, [items[p] for p in owned], prompt, sem,
+                lambda pos, text: on_item(owned[pos], text),
+            )
+        finally:
+            for p in owned:
+                _inflight_release(_cache_key(items[p][1], prompt))
+
+    async def run_waiting(p):
+        try:
+            text = await ocr_async(client, items[p][1], items[p][0], prompt, sem)
+        except Exception as e:
+            text = e
+        on_item(p, text)
+        return text
+
+    owned_texts, *waited = await asyncio.gather(
+        run_owned(),
+        *(run_waiting(p) for p in waiting),
+        return_exceptions=True,
+    )
+    if isinstance(owned_texts, Exception):
+        for p in owned:
+            on_item(p, owned_texts)
+        owned_texts = [owned_texts] * len(owned)
+    for p, text in zip(owned + waiting, list(owned_texts) + waited):
+        results[p] = text
+    return results
+
+async def ocr_pages(api_key: str, pages: list, prompt: str, on_done=None) -> list:
+    """
+    OCR a list of (fname, bytes) concurrently, preserving input order.
+    Uses a client created (and closed) on the current event loop.
+    Uncached pages are sent up to OCR_BATCH at a time per request; repeats of
+    the same image within `pages` are sent once and share the result.
+    Failed pages come back as exceptions instead of aborting the batch.
+    `on_done(finished, total)` is called as pages complete (for progress bars);
+    pages that share a batched request complete together.
+    """
+    sem = asyncio.Semaphore(OCR_CONCURRENCY)
+    results = [None] * len(pages)
+    todo = []
+    first = {}  # cache_key -> index of the first uncached page with that image
+    repeats = {}  # that index -> later indices with the same image
+    for idx, (_, data) in enumerate(pages):
+        key = _cache_key(data, prompt)
+        cached = _cache_get(key)
+        if cached is not None:
+            results[idx] = cached
+        elif key in first:
+            repeats.setdefault(first[key], []).append(idx)
+        else:
+            first[key] = idx
+            todo.append(idx)
+    finished = len(pages) - len(todo) - sum(len(r) for r in repeats.values())
+    if on_done and finished:
+        on_done(finished, len(pages))
+
+    def record(j, text):
+        nonlocal finished
+        for k in [j] + repeats.get(j, []):
+            results[k] = text
+            finished += 1
+        if on_done:
+            on_done(finished, len(pages))
+
+    async def run(batch):
+        await ocr_batch_async(
+            client, [pages[j] for j in batch], prompt, sem,
+            on_item=lambda pos, text: record(batch[pos], text),
+        )
+
+    if not todo:
+        return results
+    # short documents: spread pages over all OCR_CONCURRENCY slots instead of
+    # packing them into one big request (faster, and the progress bar moves)
+    size = max(1, min(OCR_BATCH, -(-len(todo) // OCR_CONCURRENCY)))
+    client = genai.Client(api_key=api_key)
+    try:
+        await asyncio.gather(
+            *(run(todo[k:k + size]) for k in range(0, len(todo), size))
+        )
+    finally:
+        await client.aio.aclose()
+        client.close()
+    return results
+
+def _page_matrix(page: "fitz.Page", dpi: int = RENDER_DPI) -> "fitz.Matrix":
+    zoom = dpi / 72
+    long_side = max(page.rect.width, page.rect.height) * zoom
+    if long_side > MAX_SIDE_PX:
+        zoom *= MAX_SIDE_PX / long_side
+    return fitz.Matrix(zoom, zoom)
+
+@st.cache_data(show_spinner=False, max_entries=RENDER_CACHE_PAGES, ttl=RENDER_CACHE_TTL_S)
+def render_page(pdf_key: str, page_index: int, dpi: int, _doc: "fitz.Document") -> bytes:
+    """
+    Render one page to JPEG. Cached on (pdf sha1, page, dpi); the open
+    document is left out of the hash (leading underscore).
+    """
+    page = _doc.load_page(page_index)
+    pix = page.get_pixmap(matrix=_page_matrix(page, dpi), alpha=False)
+    # read straight from the samples memoryview: skips the extra bytes object that
+    # pix.samples would build (Pillow still copies once into its own RGB image)
+    img = Image.frombuffer(
+        "RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1
+    )
+    # Pillow's optimized/progressive encoder is noticeably smaller than MuPDF's
+    buf = BytesIO()
+    img.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    img = pix = None
+    return buf.getvalue()
+
+def render_pdf_pages(raw: bytes, page_indices: list) -> list:
+    """
+    Render the given pages one after another from a single open document.
+    PyMuPDF runs MuPDF single-threaded and holds the GIL, so a thread pool
+    here would not render in parallel and isn't a supported way to drive it.
+    """
+    pdf_key = _sha1(raw)
+    with fitz.open(stream=raw, filetype="pdf") as doc:
+        return [
+            (f"page-{i + 1}.jpg", render_page(pdf_key, i, RENDER_DPI, doc))
+            for i in page_indices
+        ]
+
+def embedded_page_text(page: "fitz.Page"):
+    """The page's own text layer if it looks like real prose, else None (→ OCR it)."""
+    text = page.get_text("text").strip()
+    if len(text) <= MIN_EMBEDDED_CHARS:
+        return None
+    visible = [c for c in text if not c.isspace()]
+    if sum(c.isalpha() for c in visible) / len(visible) < MIN_EMBEDDED_ALPHA:
+        return None  # mostly symbols/numbers: likely scan artefacts or a bad text layer
+    return text
+
+def iter_docx_images(z: zipfile.ZipFile):
+    """Yield (basename, bytes) for each embedded image under word/media/."""
+    for name in z.namelist():
+        if name.startswith("word/media/"):
+            with z.open(name) as f:
+                yield os.path.basename(name), f.read()
+
+def _usage_db() -> sqlite3.Connection:
+    # sqlite handles cross-process locking on every platform; WAL keeps reads cheap
+    con = sqlite3.connect(USAGE_FILE, timeout=10, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("CREATE TABLE IF NOT EXISTS usage (day TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+    if os.path.isfile(LEGACY_USAGE_FILE):
+        # carry the old usage.json count over once, then move the file aside
+        try:
+            with open(LEGACY_USAGE_FILE, "r") as f:
+                d = json.load(f)
+            con.execute("INSERT OR IGNORE INTO usage VALUES (?, ?)", (d["date"], int(d["count"])))
+            os.replace(LEGACY_USAGE_FILE, LEGACY_USAGE_FILE + ".migrated")
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    return con
+
 def load_usage():
-    if os.path.isfile(USAGE_FILE):
-        with open(USAGE_FILE, "r") as f:
-            d = json.load(f)
-    else:
-        d = {"date": "", "count": 0}
     today = date.today().isoformat()
-    if d.get("date") != today:
-        d = {"date": today, "count": 0}
-    return d
-
-def save_usage(d):
-    with open(USAGE_FILE, "w") as f:
-        json.dump(d, f)
+    with closing(_usage_db()) as con:
+        row = con.execute("SELECT count FROM usage WHERE day = ?", (today,)).fetchone()
+    return {"date": today, "count": row[0] if row else 0}
 
-def make_pdf(text: str) -> bytes:
+def bump_usage():
+    """Atomically add one use for today."""
+    today = date.today().isoformat()
+    with closing(_usage_db()) as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute(
+                "INSERT INTO usage VALUES (?, 1) "
+                "ON CONFLICT(day) DO UPDATE SET count = count + 1",
+                (today,),
+            )
+            count = con.execute("SELECT count FROM usage WHERE day = ?", (today,)).fetchone()[0]
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+    return {"date": today, "count": count}
+
+def make_pdf(text: str, path: str) -> None:
+    # one multi_cell call: fpdf2 wraps on embedded newlines itself, so there's
+    # no need to run its layout engine once per line
     pdf = FPDF()
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.set_font("Arial", size=12)
-    for line in text.splitlines():
-        pdf.multi_cell(0, 10, line)
-    return pdf.output(dest="S").encode("latin1")
-
-def make_docx(text: str) -> bytes:
+    if os.path.isfile(PDF_FONT_FILE):
+        pdf.add_font("DejaVu", fname=PDF_FONT_FILE)
+        pdf.set_font("DejaVu", size=12)
+    else:
+        # core fonts only cover windows-1252 (which keeps curly quotes, dashes and
+        # the euro sign); anything else comes out as "?" and run_ocr warns about it
+        pdf.core_fonts_encoding = "windows-1252"
+        pdf.set_font("Helvetica", size=12)
+        text = text.encode("cp1252", "replace").decode("cp1252")
+    pdf.multi_cell(0, 10, text)
+    pdf.output(path)
+
+def make_docx(text: str, path: str) -> None:
     doc = Document()
     for line in text.splitlines():
         doc.add_paragraph(line)
-    buf = BytesIO()
-    doc.save(buf)
-    return buf.getvalue()
+    doc.save(path)
+
+def _unlink_quietly(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def export_file(text: str, output_type: str) -> str:
+    """Write the export to a temp file and return its path; the caller deletes it."""
+    ext = output_type.lower()
+    with tempfile.NamedTemporaryFile(delete=False, suffix="." + ext) as tmp:
+        path = tmp.name
+    try:
+        if output_type == "TXT":
+            with open(path, "wb") as f:
+                f.write(text.encode("utf-8"))
+        elif output_type == "PDF":
+            make_pdf(text, path)
+        else:  # DOCX
+            make_docx(text, path)
+    except Exception:
+        _unlink_quietly(path)
+        raise
+    return path
 
 st.title("Handwritten to Text")
 
@@ -166,8 +696,8 @@ else:
 input_type = st.selectbox("Select input type:", ["Image", "PDF", "Word"])
 output_type = st.selectbox("Select output format:", ["TXT", "PDF", "DOCX"])
 
-# Only for PDF/Word, show a cautionary note
-if input_type in ("PDF", "Word"):
+# Only for Word, show a cautionary note (PDF pages with a text layer are read directly)
+if input_type == "Word":
     st.warning("Make sure your documents contain **pictures** of handwriting, _not_ embedded text.")
 
 ext_map = {
@@ -177,106 +707,168 @@ ext_map = {
 }
 upload = st.file_uploader(f"Upload your {input_type} file", type=ext_map[input_type])
 
-if upload and st.button("▶️ Convert"):
-    if use_default:
-        usage = load_usage()
-        if usage["count"] >= DAILY_LIMIT:
-            st.error(f"You’ve hit the {DAILY_LIMIT}/day limit with the default API.")
-            st.stop()
+@st.fragment
+def run_ocr(upload, input_type: str, output_type: str, api_key: str, use_default: bool):
+    """
+    Convert button + results, rerun on their own so clicking Convert/Download
+    doesn't re-execute the whole page. The extracted text is kept in
+    st.session_state, so switching the output format re-exports it without
+    another OCR pass.
+    """
+    upload_id = (getattr(upload, "file_id", upload.name), input_type)
+
+    if st.button("▶️ Convert"):
+        if use_default:
+            usage = load_usage()
+            if usage["count"] >= DAILY_LIMIT:
+                st.error(f"You’ve hit the {DAILY_LIMIT}/day limit with the default API.")
+                return
+
+        if not api_key:
+            st.error("❗ Please enter a valid API key.")
+            return
+
+        client = get_client(api_key)
+        prompt = (
+            f"Please extract all handwritten text from this {input_type} exactly as it appears, "
+            "without adding or removing anything."
+        )
+
+        with st.spinner("Running OCR…"):
+            try:
+                # fragment reruns reuse the same UploadedFile, which may already be read
+                upload.seek(0)
+                texts = []
+
+                if input_type == "Image":
+                    texts.append(ocr_with_gemini(client, upload.read(), upload.name, prompt))
+
+                elif input_type == "PDF":
+                    raw = upload.read()
+                    with fitz.open(stream=raw, filetype="pdf") as doc:
+                        if doc.page_count == 0:
+                            st.error("No pages found in the PDF.")
+                            return
+
+                        # born-digital pages already carry their text; no need to OCR them
+                        results = [embedded_page_text(page) for page in doc]
+
+                    to_ocr = [i for i, text in enumerate(results) if text is None]
+                    if len(to_ocr) < len(results):
+                        st.info(
+                            f"Extracted embedded text for {len(results) - len(to_ocr)}/"
+                            f"{len(results)} pages, OCR'd the rest."
+                        )
+
+                    # Render the remaining pages to JPEG with PyMuPDF (no Poppler needed)
+                    pages = render_pdf_pages(raw, to_ocr)
+
+                    # OCR all pages concurrently (bounded by OCR_CONCURRENCY)
+                    prog = st.progress(0.0)
+                    ocr_results = asyncio.run(ocr_pages(
+                        api_key, pages, prompt,
+                        on_done=lambda n, total: prog.progress(n / total),
+                    )) if pages else []
+                    prog.progress(1.0)
+                    del pages  # page images are no longer needed
+                    for i, res in zip(to_ocr, ocr_results):
+                        results[i] = res
+                    for i, res in enumerate(results, start=1):
+                        if isinstance(res, Exception):
+                            # Don’t kill the whole run if one page is stubborn
+                            texts.append(f"[Page {i} failed after retries: {res}]")
+                        else:
+                            texts.append(res)
+
+                else:  # Word (.docx)
+                    # Extract embedded images and OCR them
+                    # ZipFile reads the upload handle directly (no BytesIO copy of the file).
+                    # All decompressed images are still held at once: ocr_pages needs the
+                    # full list to dedupe and batch them.
+                    with zipfile.ZipFile(upload) as z:
+                        payloads = list(iter_docx_images(z))
+                    if not payloads:
+                        st.error("No embedded images found in the Word document.")
+                        return
+
+                    # same bounded concurrent path as PDF pages; retries handle pacing
+                    prog = st.progress(0.0)
+                    results = asyncio.run(ocr_pages(
+                        api_key, payloads, prompt,
+                        on_done=lambda n, total: prog.progress(n / total),
+                    ))
+                    for i, res in enumerate(results, start=1):
+                        if isinstance(res, Exception):
+                            texts.append(f"[Image {i} failed after retries: {res}]")
+                        else:
+                            texts.append(res)
+
+                full_text = PAGE_BREAK.join(t.strip() for t in texts)
+                st.session_state["ocr_result"] = {"id": upload_id, "text": full_text}
+
+                if use_default and st.session_state["ocr_result"]["text"].strip():
+                    usage = bump_usage()
+                    st.info(f"✅ Default-API usage: {usage['count']}/{DAILY_LIMIT}")
 
-    if not api_key:
-        st.error("❗ Please enter a valid API key.")
-        st.stop()
+            except Exception as e:
+                st.error(f"❌ Error: {e}")
+                return
 
-    client = genai.Client(api_key=api_key)
-    prompt = (
-        f"Please extract all handwritten text from this {input_type} exactly as it appears, "
-        "without adding or removing anything."
-    )
+    result = st.session_state.get("ocr_result")
+    if not result or result["id"] != upload_id:
+        return
+    full_text = result["text"]
 
-    with st.spinner("Running OCR…"):
-        try:
-            raw = upload.read()
-            texts = []
-
-            if input_type == "Image":
-                texts.append(ocr_with_gemini(client, raw, upload.name, prompt))
-
-            elif input_type == "PDF":
-                # Render each PDF page to a PNG with PyMuPDF (no Poppler needed)
-                with fitz.open(stream=raw, filetype="pdf") as doc:
-                    if doc.page_count == 0:
-                        st.error("No pages found in the PDF.")
-                        st.stop()
-
-                    # 200 DPI is usually enough for handwriting & faster/cheaper
-                    zoom = 200 / 72
-                    mat = fitz.Matrix(zoom, zoom)
-                    prog = st.progress(0.0)
-                    total = doc.page_count
-
-                    for i, page in enumerate(doc, start=1):
-                        try:
-                            pix = page.get_pixmap(matrix=mat, alpha=False)
-                            img_bytes = pix.tobytes("png")
-                            text_i = ocr_with_gemini(
-                                client, img_bytes, f"page-{i}.png", prompt
-                            )
-                            texts.append(text_i)
-                        except Exception as e:
-                            # Don’t kill the whole run if one page is stubborn
-                            texts.append(f"[Page {i} failed after retries: {e}]")
-                        finally:
-                            # small pacing helps reduce 503s
-                            time.sleep(0.2)
-                            prog.progress(i / total)
-
-            else:  # Word (.docx)
-                # Extract embedded images and OCR them
-                z = zipfile.ZipFile(BytesIO(raw))
-                imgs = [n for n in z.namelist() if n.startswith("word/media/")]
-                if not imgs:
-                    st.error("No embedded images found in the Word document.")
-                    st.stop()
-                for i, name in enumerate(imgs, start=1):
-                    img_bytes = z.read(name)
-                    try:
-                        texts.append(ocr_with_gemini(client, img_bytes, os.path.basename(name), prompt))
-                    except Exception as e:
-                        texts.append(f"[Image {i} failed after retries: {e}]")
-                    time.sleep(0.2)
-
-            full_text = "\n\n--- Page Break ---\n\n".join(t.strip() for t in texts)
-
-            if not full_text.strip():
-                st.warning("⚠️ No text detected.")
-            else:
-                st.success("✅ Extracted text:")
-                st.text_area("", full_text, height=250)
-
-                # prepare output
-                if output_type == "TXT":
-                    data_out, ext, mime = full_text.encode("utf-8"), "txt", "text/plain"
-                elif output_type == "PDF":
-                    data_out, ext, mime = make_pdf(full_text), "pdf", "application/pdf"
-                else:  # DOCX
-                    data_out, ext, mime = make_docx(full_text), "docx", \
-                        "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-
-                st.download_button(
-                    f"📥 Download .{ext}",
-                    data=data_out,
-                    file_name=f"output.{ext}",
-                    mime=mime,
-                )
+    if not full_text.strip():
+        st.warning("⚠️ No text detected.")
+        return
 
-                if use_default:
-                    usage["count"] += 1
-                    save_usage(usage)
-                    st.info(f"✅ Default-API usage: {usage['count']}/{DAILY_LIMIT}")
+    st.success("✅ Extracted text:")
+    st.text_area("", full_text, height=250)
 
-        except Exception as e:
-            st.error(f"❌ Error: {e}")
+    if output_type == "PDF" and not os.path.isfile(PDF_FONT_FILE):
+        try:
+            full_text.encode("cp1252")
+        except UnicodeEncodeError:
+            st.warning(
+                f"⚠️ Some characters can't be drawn without {PDF_FONT_FILE} and will "
+                "show as '?' in the PDF. Put the font next to script.py, or pick TXT/DOCX."
+            )
+
+    try:
+        # prepare output: built from the current text and kept next to ocr_result,
+        # so reruns that change neither the text nor the format reuse it
+        export_key = (hashlib.sha1(full_text.encode("utf-8")).hexdigest(), output_type)
+        export = st.session_state.get("ocr_export")
+        if not export or export["key"] != export_key:
+            path = export_file(full_text, output_type)
+            try:
+                with open(path, "rb") as f:
+                    data_out = f.read()
+            finally:
+                _unlink_quietly(path)
+            export = {"key": export_key, "data": data_out}
+            st.session_state["ocr_export"] = export
+
+        if output_type == "TXT":
+            ext, mime = "txt", "text/plain"
+        elif output_type == "PDF":
+            ext, mime = "pdf", "application/pdf"
+        else:  # DOCX
+            ext, mime = "docx", \
+                "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+        st.download_button(
+            f"📥 Download .{ext}",
+            data=export["data"],
+            file_name=f"output.{ext}",
+            mime=mime,
+        )
+    except Exception as e:
+        st.error(f"❌ Error: {e}")
+
+if upload:
+    run_ocr(upload, input_type, output_type, api_key, use_default)
 
 
 